@@ -1 +1,11 @@
 from datashield_opal.impl import OpalDriver as OpalDriver
+from datashield_opal.impl import as_completed as as_completed
+from datashield_opal.impl import wait_any as wait_any
+from datashield_opal.impl import RequestLimiter as RequestLimiter
+from datashield_opal.impl import PRIORITY_INTERACTIVE as PRIORITY_INTERACTIVE
+from datashield_opal.impl import PRIORITY_NORMAL as PRIORITY_NORMAL
+from datashield_opal.impl import PRIORITY_BULK as PRIORITY_BULK
+from datashield_opal.impl import RetryPolicy as RetryPolicy
+from datashield_opal.impl import CircuitBreaker as CircuitBreaker
+from datashield_opal.impl import RecordingTransport as RecordingTransport
+from datashield_opal.impl import ReplayTransport as ReplayTransport
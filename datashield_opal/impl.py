@@ -2,11 +2,39 @@
 DataSHIELD Interface implementation for Opal.
 """
 
+import base64
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
 from argparse import Namespace
-from contextlib import suppress
+from collections.abc import Callable, Generator, Iterator
+from concurrent import futures
+from contextlib import contextmanager, suppress
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
+from urllib.parse import urlparse
 from obiba_opal.core import OpalClient, UriBuilder, OpalRequest, OpalResponse, HTTPError
+from requests import (
+    ConnectionError as RequestsConnectionError,
+    PreparedRequest,
+    ReadTimeout,
+    RequestException,
+    Response,
+    Session,
+)
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 from datashield.interface import DSLoginInfo, DSDriver, DSConnection, DSResult, DSError, RSession
 
+if TYPE_CHECKING:
+    # pandas is an optional dependency, only needed for decoding as a data frame
+    import pandas
+
 
 class OpalDSError(DSError):
     def __init__(self, exception: Exception = None):
@@ -23,17 +51,509 @@ class OpalDSError(DSError):
         return isinstance(self.exception, HTTPError) and self.exception.code >= 500
 
 
+class OpalUnavailableError(OpalDSError):
+    """
+    The request was not sent, the Opal server being considered as unavailable after repeated failures.
+    """
+
+    def is_client_error(self) -> bool:
+        return False
+
+    def is_server_error(self) -> bool:
+        return True
+
+
+# Request priorities, the lowest value is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+
+class RequestLimiter:
+    """
+    Limits the requests sent to an Opal server: maximum number of requests in flight and token-bucket rate.
+    The waiting requests are served by priority, then in order of arrival.
+    """
+
+    def __init__(self, max_in_flight: int = None, rate: float = None, burst: int = None):
+        """
+        :param max_in_flight: The maximum number of concurrent requests, no limit if None
+        :param rate: The maximum number of requests per second, no limit if None
+        :param burst: The number of requests that can be sent at once when the rate is limited, defaults to the rate
+        """
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate)) if rate is not None else None
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        # metrics
+        self._requests = 0
+        self._max_queued = 0
+        self._wait_time = 0.0
+
+    @contextmanager
+    def acquire(self, priority: int = PRIORITY_NORMAL) -> Generator[None, None, None]:
+        """
+        Wait for the request to be allowed, and release its slot once done.
+
+        :param priority: The request priority, the lowest value is served first
+        """
+        started = time.monotonic()
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._queue, ticket)
+            self._max_queued = max(self._max_queued, len(self._queue))
+            try:
+                while True:
+                    delay = None
+                    has_slot = self.max_in_flight is None or self._in_flight < self.max_in_flight
+                    if self._queue[0] == ticket and has_slot:
+                        delay = self._take_token()
+                        if delay == 0:
+                            break
+                    self._cond.wait(delay)
+            except BaseException:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._queue)
+            self._in_flight = self._in_flight + 1
+            self._requests = self._requests + 1
+            self._wait_time = self._wait_time + time.monotonic() - started
+            # let the next request check whether it is allowed
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight = self._in_flight - 1
+                self._cond.notify_all()
+
+    def get_stats(self) -> dict:
+        """
+        Get the limiter metrics.
+
+        :return: The number of requests in flight, queued (total and per priority), the maximum queue depth,
+            the number of allowed requests and their total waiting seconds
+        """
+        with self._cond:
+            queued = {}
+            for priority, _ in self._queue:
+                queued[priority] = queued.get(priority, 0) + 1
+            return {
+                "in_flight": self._in_flight,
+                "queued": len(self._queue),
+                "queued_by_priority": queued,
+                "max_queued": self._max_queued,
+                "requests": self._requests,
+                "wait_time": self._wait_time,
+            }
+
+    def _take_token(self) -> float:
+        # seconds to wait for a token, 0 if one was taken
+        if self.rate is None:
+            return 0
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self._tokens >= 1:
+            self._tokens = self._tokens - 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+class RetryPolicy:
+    """
+    Retries the idempotent (GET) requests that failed because of a server error or of a network error,
+    with exponential backoff and full jitter.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 10.0,
+        timeout: float | tuple[float, float] = None,
+    ):
+        """
+        :param max_retries: The maximum number of retries of a request
+        :param backoff: The base delay in seconds, doubled at each retry
+        :param max_backoff: The maximum delay in seconds
+        :param timeout: The connect and read timeout in seconds of each request, a (connect, read) tuple to have
+            different ones, no timeout if None. A request that times out is a failure, retried if idempotent.
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+    def get_delay(self, attempt: int) -> float:
+        """
+        Get the seconds to wait before retrying.
+
+        :param attempt: The number of the retries already done
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+
+class CircuitBreaker:
+    """
+    Fails fast the requests to an Opal server after repeated failures (server or network errors). Once the reset
+    timeout is elapsed, a single probe request is let through: the circuit is closed again if it succeeds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        :param failure_threshold: The number of consecutive failures that opens the circuit
+        :param reset_timeout: The seconds before probing the server again
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened = None
+        self._probing = False
+
+    def get_state(self) -> str:
+        with self._lock:
+            if self._opened is None:
+                return self.CLOSED
+            return self.HALF_OPEN if time.monotonic() - self._opened >= self.reset_timeout else self.OPEN
+
+    def allow(self) -> bool:
+        """
+        Get whether a request can be sent. In half-open state, only one probe request is allowed at a time.
+        """
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._probing or time.monotonic() - self._opened < self.reset_timeout:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures = self._failures + 1
+            if self._probing or self._failures >= self.failure_threshold:
+                # (re)open the circuit
+                self._opened = time.monotonic()
+            self._probing = False
+
+    def release(self) -> None:
+        """
+        Release the half-open probe after a request that says nothing about the health of the server, so that
+        another request can probe it.
+        """
+        with self._lock:
+            self._probing = False
+
+
+class _ManagedRequest(OpalRequest):
+    """
+    Opal request that is sent once allowed by the limiters and by the circuit breaker, and retried on failure
+    according to the retry policy.
+    """
+
+    def __init__(
+        self,
+        client: OpalClient,
+        limiters: list[RequestLimiter],
+        priority: int,
+        retry: RetryPolicy = None,
+        breaker: CircuitBreaker = None,
+    ):
+        super().__init__(client)
+        self.limiters = limiters
+        self.priority = priority
+        self.retry = retry
+        self.breaker = breaker
+
+    def send(self, fp=None) -> OpalResponse:
+        attempt = 0
+        while True:
+            if self.breaker is not None and not self.breaker.allow():
+                host = urlparse(self.client.base_url).netloc
+                raise OpalUnavailableError(
+                    ConnectionError(f"Opal server {host} is unavailable, after repeated failures")
+                )
+            error = None
+            response = None
+            try:
+                response = self._send(0, fp)
+                failed = response.code >= 500
+            except HTTPError as e:
+                error = e
+                failed = e.is_server_error()
+            except ReadTimeout as e:
+                if "timeout" in self.options:
+                    # the caller's own read timeout (long polling) is expected, it is not a failure of the server
+                    if self.breaker is not None:
+                        self.breaker.release()
+                    raise
+                error = e
+                failed = True
+            except RequestException as e:
+                error = e
+                failed = True
+            except BaseException:
+                # any other error (interrupt, decoding...) must not leave the half-open probe pending forever
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+                raise
+            if self.breaker is not None:
+                if failed:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+            if not failed or not self._is_retryable(attempt):
+                if error is not None:
+                    raise error
+                return response
+            time.sleep(self.retry.get_delay(attempt))
+            attempt = attempt + 1
+
+    def _is_retryable(self, attempt: int) -> bool:
+        return self.retry is not None and self._method == "GET" and attempt < self.retry.max_retries
+
+    def _send(self, index: int, fp) -> OpalResponse:
+        if index == len(self.limiters):
+            # the timeout set on the request, else the one of the retry policy
+            timeout = self.options.get("timeout", self.retry.timeout if self.retry is not None else None)
+            _request_timeout.value = timeout
+            try:
+                return super().send(fp)
+            finally:
+                _request_timeout.value = None
+        with self.limiters[index].acquire(self.priority):
+            return self._send(index + 1, fp)
+
+
+# Timeout of the request being sent by the current thread, see _TimeoutSession
+_request_timeout = threading.local()
+
+
+class _TimeoutSession(Session):
+    """
+    Session that applies the timeout of the request being sent, OpalRequest not passing it to the transport.
+    """
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = getattr(_request_timeout, "value", None)
+        return super().send(request, **kwargs)
+
+
+#
+# Transports
+#
+
+# Response headers that are recorded, the others (cookies etc.) are dropped
+_RECORDED_HEADERS = ["Content-Type", "Location", "X-Opal-Version"]
+
+
+def _exchange_key(method: str, url: str, body: bytes | str) -> str:
+    # the server address is ignored, the request body is only identified by its digest
+    parsed = urlparse(url)
+    path = parsed.path + ("?" + parsed.query if parsed.query else "")
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    digest = hashlib.sha1(body).hexdigest() if body else ""
+    return f"{method} {path} {digest}"
+
+
+class RecordingTransport(HTTPAdapter):
+    """
+    Transport that sends the requests to the Opal server and records the exchanges (request key, response status,
+    headers, content and latency) in a gzipped JSON lines file. Secrets are not recorded: the request headers
+    (credentials, cookies) are dropped, as well as the response headers that are not needed for replay.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        """
+        :param path: The file where the exchanges are saved on close
+        """
+        super().__init__(**kwargs)
+        self.path = path
+        self.exchanges = []
+        self._lock = threading.Lock()
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        started = time.perf_counter()
+        response = super().send(request, **kwargs)
+        # read the content now, to include the transfer in the latency
+        content = response.content
+        latency = time.perf_counter() - started
+        exchange = {
+            "key": _exchange_key(request.method, request.url, request.body),
+            "status": response.status_code,
+            "headers": {name: response.headers[name] for name in _RECORDED_HEADERS if name in response.headers},
+            "content": base64.b64encode(content).decode("ascii") if content else None,
+            "latency": latency,
+        }
+        with self._lock:
+            self.exchanges.append(exchange)
+        return response
+
+    def save(self) -> None:
+        with self._lock, gzip.open(self.path, "wt", encoding="utf-8") as file:
+            for exchange in self.exchanges:
+                file.write(json.dumps(exchange, separators=(",", ":")) + "\n")
+
+    def close(self) -> None:
+        self.save()
+        super().close()
+
+
+class ReplayTransport(BaseAdapter):
+    """
+    Transport that replays the exchanges recorded by a RecordingTransport, without connecting to any server.
+    Identical requests get the recorded responses in order, the last one being repeated once exhausted.
+    """
+
+    def __init__(self, path: str, latency_scale: float = 1.0):
+        """
+        :param path: The file of the recorded exchanges
+        :param latency_scale: The factor applied to the recorded latencies, 0 to reply immediately
+        """
+        super().__init__()
+        self.path = path
+        self.latency_scale = latency_scale
+        self.exchanges = {}
+        self._lock = threading.Lock()
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            for line in file:
+                exchange = json.loads(line)
+                self.exchanges.setdefault(exchange["key"], []).append(exchange)
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        key = _exchange_key(request.method, request.url, request.body)
+        with self._lock:
+            exchanges = self.exchanges.get(key)
+            if not exchanges:
+                raise RequestsConnectionError(f"No recorded exchange for: {key}", request=request)
+            exchange = exchanges.pop(0) if len(exchanges) > 1 else exchanges[0]
+        if self.latency_scale > 0:
+            time.sleep(exchange["latency"] * self.latency_scale)
+        response = Response()
+        response.status_code = exchange["status"]
+        response.headers = CaseInsensitiveDict(exchange["headers"])
+        response._content = base64.b64decode(exchange["content"]) if exchange["content"] else b""
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+def _build_client(loginInfo: OpalClient.LoginInfo, transport: BaseAdapter = None) -> OpalClient:
+    class TransportClient(OpalClient):
+        def __init__(self, server=None):
+            super().__init__(server)
+            self.session = _TimeoutSession()
+            if transport is not None:
+                self.session.mount("http://", transport)
+                self.session.mount("https://", transport)
+
+    # same as OpalClient.build(), the session being set before the first request
+    data = loginInfo.data
+    if loginInfo.isSsl():
+        return TransportClient.buildWithCertificate(data["server"], data["cert"], data["key"], data["no_ssl_verify"])
+    elif loginInfo.isToken():
+        return TransportClient.buildWithToken(data["server"], data["token"], data["no_ssl_verify"])
+    else:
+        return TransportClient.buildWithAuthentication(
+            data["server"], data["user"], data["password"], data["no_ssl_verify"]
+        )
+
+
+class _SingleFlight:
+    """
+    Coalesces the concurrent calls sharing the same key: the first caller executes the call, the others wait for
+    its outcome (value or exception) instead of executing it again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # number of executed calls and of calls that shared the outcome of an executed one
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key: any, func: Callable[[], any]) -> any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = futures.Future()
+                self._calls[key] = call
+                self.executed = self.executed + 1
+            else:
+                self.coalesced = self.coalesced + 1
+        if not leader:
+            return call.result()
+        try:
+            call.set_result(func())
+        except BaseException as e:
+            call.set_exception(e)
+        finally:
+            # next calls with the same key are executed again
+            with self._lock:
+                del self._calls[key]
+        return call.result()
+
+    def get_stats(self) -> dict:
+        return {"executed": self.executed, "coalesced": self.coalesced}
+
+
 class OpalRSession(RSession):
-    def __init__(self, client: OpalClient, profile: str = None, restore: str = None, verbose: bool = False):
+    def __init__(
+        self,
+        client: OpalClient,
+        profile: str = None,
+        restore: str = None,
+        verbose: bool = False,
+        new_request: Callable[[int], OpalRequest] = None,
+    ):
+        """
+        :param client: The Opal client
+        :param profile: The DataSHIELD profile of the R session
+        :param restore: The workspace to restore in the R session
+        :param verbose: Whether the requests are verbose
+        :param new_request: The factory of the requests by priority, such as the connection's one that applies its
+            limiters, retry policy and circuit breaker; defaults to the plain client requests
+        """
         self.client = client
         self.profile = profile
         self.restore = restore
         self.verbose = verbose
+        self.new_request = new_request if new_request is not None else lambda priority: client.new_request()
         self.id = None
+        # serializes the start and close of the R session
+        self._lock = threading.RLock()
 
     def get_id(self) -> str:
         if self.id is None:
-            self.start(False)
+            with self._lock:
+                # another thread may have started the session meanwhile
+                if self.id is None:
+                    self.start(False)
         return self.id
 
     def start(self, asynchronous: bool = True) -> None:
@@ -42,13 +562,14 @@ class OpalRSession(RSession):
             builder.query("profile", self.profile)
         if self.restore is not None:
             builder.query("restore", self.restore)
-        response = self._post(builder.build()).send()
-        if response.code != 201:
-            raise OpalDSError(ValueError(f"Failed to start R session: {response.code}"))
-        session = response.from_json()
-        if "id" not in session:
-            raise OpalDSError(ValueError("Failed to start R session: no session id returned"))
-        self.id = session["id"]
+        with self._lock:
+            response = self._post(builder.build()).send()
+            if response.code != 201:
+                raise OpalDSError(ValueError(f"Failed to start R session: {response.code}"))
+            session = response.from_json()
+            if "id" not in session:
+                raise OpalDSError(ValueError("Failed to start R session: no session id returned"))
+            self.id = session["id"]
 
     def is_started(self) -> bool:
         return self.id is not None
@@ -107,40 +628,76 @@ class OpalRSession(RSession):
         return "No recent events"
 
     def close(self) -> None:
-        if self.id is not None:
-            builder = UriBuilder(["datashield", "session", self.id])
-            self._delete(builder.build()).send()
-            self.id = None
-
-    def _post(self, ws: str) -> OpalRequest:
-        request = self.client.new_request()
+        with self._lock:
+            if self.id is not None:
+                builder = UriBuilder(["datashield", "session", self.id])
+                self._delete(builder.build()).send()
+                self.id = None
+
+    def _post(self, ws: str, priority: int = PRIORITY_NORMAL) -> OpalRequest:
+        request = self.new_request(priority)
         if self.verbose:
             request.verbose()
         return request.accept_json().post().resource(ws)
 
-    def _get(self, ws: str) -> OpalRequest:
-        request = self.client.new_request()
+    def _get(self, ws: str, priority: int = PRIORITY_INTERACTIVE) -> OpalRequest:
+        # status checks are light and usually awaited
+        request = self.new_request(priority)
         if self.verbose:
             request.verbose()
         return request.accept_json().get().resource(ws)
 
-    def _delete(self, ws: str) -> OpalRequest:
-        request = self.client.new_request()
+    def _delete(self, ws: str, priority: int = PRIORITY_NORMAL) -> OpalRequest:
+        request = self.new_request(priority)
         if self.verbose:
             request.verbose()
         return request.accept_json().delete().resource(ws)
 
 
 class OpalConnection(DSConnection):
-    def __init__(self, name: str, loginInfo: OpalClient.LoginInfo, profile: str = "default", restore: str = None):
+    def __init__(
+        self,
+        name: str,
+        loginInfo: OpalClient.LoginInfo,
+        profile: str = "default",
+        restore: str = None,
+        transport: BaseAdapter = None,
+    ):
         self.name = name
-        self.client = OpalClient.build(loginInfo)
+        # the transport of the HTTP requests, see RecordingTransport and ReplayTransport
+        self.transport = transport
+        self.client = _build_client(loginInfo, transport)
         self.subject = None
         self.profile = profile
         self.restore = restore
         self.verbose = False
+        # whether the server-side R commands are removed once their result is fetched
+        self.cleanup_commands = False
         self.rsession = None
         self.rsession_started = False
+        # additional R sessions, for running independent analyses in parallel
+        self.rsessions = []
+        # R session assigned to each routing key, see route_session()
+        self._routes = {}
+        # serializes the lazy initialization of the R sessions and of the subject
+        self._session_lock = threading.RLock()
+        self._subject_lock = threading.Lock()
+        # shares concurrent identical catalogue requests
+        self._listings = _SingleFlight()
+        # catalogue requests run in background, served once to the next callers
+        self._prefetched = {}
+        self._prefetcher = None
+        self._prefetch_lock = threading.Lock()
+        # seconds during which a prefetched catalogue can be served
+        self.prefetch_ttl = 30.0
+        self._closed = False
+        # limits the requests sent by this connection, see also set_host_limiter()
+        self.limiter = None
+        # retries the failed idempotent requests, see also set_host_breaker()
+        self.retry = None
+        # cumulated timings of the fetched results
+        self._timings = {}
+        self._timings_lock = threading.Lock()
 
     def get_name(self) -> str:
         """Get the name of the connection."""
@@ -159,8 +716,7 @@ class OpalConnection(DSConnection):
     #
 
     def list_tables(self) -> list:
-        response = self._get("/datasources").fail_on_error().send()
-        datasources = response.from_json()
+        datasources = self._get_listing("/datasources")
         names = []
         for ds in datasources:
             if "table" in ds:
@@ -176,40 +732,68 @@ class OpalConnection(DSConnection):
         response = self._get(UriBuilder(["datasource", parts[0], "table", parts[1]]).build()).send()
         return response.code == 200
 
-    def list_table_variables(self, table) -> list:
+    def list_table_variables(self, table, as_frame: bool = False) -> "list | pandas.DataFrame":
+        """
+        List the variables of a table.
+
+        :param table: The table name, in format "datasource.table"
+        :param as_frame: Whether the variables are converted to a pandas DataFrame, one row per variable
+        :return: The variables, decoded from JSON or as a DataFrame
+        """
         # table is in format "datasource.table"
         if "." not in table:
             raise OpalDSError(ValueError(f"Invalid table name: {table}. Expected format 'datasource.table'"))
         tokens = table.split(".")
         project_name = tokens[0]
         table_name = tokens[1]
-        return (
+        variables = (
             self
-            ._get(UriBuilder(["datasource", project_name, "table", table_name, "variables"]).build())
+            ._get(
+                UriBuilder(["datasource", project_name, "table", table_name, "variables"]).build(),
+                priority=PRIORITY_BULK,
+            )
             .fail_on_error()
             .send()
             .from_json()
         )
+        # one row per variable, with a column per property and per attribute
+        return _variables_to_frame(variables) if as_frame else variables
 
     def list_taxonomies(self) -> list:
-        return self._get(UriBuilder(["system", "conf", "taxonomies"]).build()).fail_on_error().send().from_json()
-
-    def search_variables(self, query) -> dict:
         return (
             self
-            ._get(UriBuilder(["datasources", "variables", "_search"]).query("query", query).build())
+            ._get(UriBuilder(["system", "conf", "taxonomies"]).build(), priority=PRIORITY_BULK)
+            .fail_on_error()
+            .send()
+            .from_json()
+        )
+
+    def search_variables(self, query, as_frame: bool = False) -> "dict | pandas.DataFrame":
+        """
+        Search the variables of the tables.
+
+        :param query: The search query
+        :param as_frame: Whether the hits are converted to a pandas DataFrame, one row per hit
+        :return: The search result, decoded from JSON or as a DataFrame
+        """
+        result = (
+            self
+            ._get(
+                UriBuilder(["datasources", "variables", "_search"]).query("query", query).build(),
+                priority=PRIORITY_BULK,
+            )
             .fail_on_error()
             .send()
             .from_json()
         )
+        # one row per hit, with a column per field
+        return _hits_to_frame(result) if as_frame else result
 
     def list_resources(self) -> list:
-        response = self._get("/projects").fail_on_error().send()
-        projects = response.from_json()
+        projects = self._get_listing("/projects")
         names = []
         for project in projects:
-            response = self._get(UriBuilder(["project", project["name"], "resources"]).build()).fail_on_error().send()
-            resources = response.from_json()
+            resources = self._get_listing(UriBuilder(["project", project["name"], "resources"]).build())
             for resource in resources:
                 names.append(project["name"] + "." + resource["name"])
         return names
@@ -231,9 +815,14 @@ class OpalConnection(DSConnection):
     def start_session(self, asynchronous: bool = True) -> RSession:
         if self.rsession is not None:
             return self.rsession
-        self.rsession = OpalRSession(self.client, profile=self.profile, restore=self.restore, verbose=self.verbose)
-        self.rsession.start(asynchronous=asynchronous)
-        self.rsession_started = not asynchronous or not self.rsession.is_pending()
+        with self._session_lock:
+            # another thread may have started the session meanwhile
+            if self.rsession is None:
+                rsession = self._new_rsession()
+                rsession.start(asynchronous=asynchronous)
+                self.rsession_started = not asynchronous or not rsession.is_pending()
+                # publish the session once started
+                self.rsession = rsession
         return self.rsession
 
     def is_session_started(self) -> bool:
@@ -249,6 +838,87 @@ class OpalConnection(DSConnection):
             raise OpalDSError(ValueError("No R session established. Please start a session first."))
         return self.rsession
 
+    def start_sessions(self, count: int, asynchronous: bool = False, timeout: float = 60.0) -> list[RSession]:
+        """
+        Ensure that the connection manages the given number of R sessions, including the default one. Each R session
+        being single-threaded, independent analyses can then be run in parallel on the server by providing different
+        sessions to the assign, aggregate and symbols functions.
+
+        :param count: The total number of R sessions
+        :param asynchronous: Whether to return without waiting for the additional R sessions to be running
+        :param timeout: The maximum number of seconds to wait for the additional R sessions to be running
+        :return: The list of the R sessions, the default one being the first
+        :raises OpalDSError: If some R sessions are still pending after the timeout, they are kept by the connection
+        """
+        if count < 1:
+            raise OpalDSError(ValueError(f"Invalid number of R sessions: {count}"))
+        self.start_session(asynchronous=False)
+        with self._session_lock:
+            rsessions = list(self.rsessions)
+            while len(rsessions) < count - 1:
+                rsession = self._new_rsession()
+                # start all sessions in parallel on the server side
+                rsession.start(asynchronous=True)
+                rsessions.append(rsession)
+            # replace the list instead of mutating it, for lock-free readers
+            self.rsessions = rsessions
+        if not asynchronous:
+            deadline = time.monotonic() + timeout
+            while any(rsession.is_pending() for rsession in rsessions):
+                if time.monotonic() >= deadline:
+                    raise OpalDSError(TimeoutError(f"R sessions still pending after {timeout}s"))
+                time.sleep(0.1)
+        return self.get_sessions()
+
+    def get_sessions(self) -> list[RSession]:
+        """
+        Get the R sessions managed by the connection, the default one being the first.
+
+        :return: The list of the R sessions, empty if no session was started
+        """
+        return [] if self.rsession is None else [self.rsession, *self.rsessions]
+
+    def route_session(self, key: str) -> RSession:
+        """
+        Get the R session that is assigned to a key (a symbol namespace, a job name etc.). The same key is always
+        routed to the same R session, also when sessions are added. A new key is assigned to the R session with
+        the least keys.
+
+        :param key: The routing key
+        :return: The R session
+        """
+        self.start_session(asynchronous=False)
+        with self._session_lock:
+            rsession = self._routes.get(key)
+            if rsession is None:
+                loads = {id(x): 0 for x in self.get_sessions()}
+                for routed in self._routes.values():
+                    loads[id(routed)] = loads[id(routed)] + 1
+                rsession = min(self.get_sessions(), key=lambda x: loads[id(x)])
+                self._routes[key] = rsession
+            return rsession
+
+    def purge_commands(self) -> int:
+        """
+        Remove the completed or failed R commands from the server-side R sessions. The results of these commands
+        that were not fetched yet are lost.
+
+        :return: The number of removed commands
+        """
+        count = 0
+        for rsession in self.get_sessions():
+            if not rsession.is_started():
+                continue
+            session_id = rsession.get_id()
+            builder = UriBuilder(["datashield", "session", session_id, "commands"])
+            commands = self._get(builder.build()).fail_on_error().send().from_json()
+            for cmd in commands:
+                if cmd.get("status") in ["COMPLETED", "FAILED"]:
+                    builder = UriBuilder(["datashield", "session", session_id, "command", cmd["id"]])
+                    if self._delete(builder.build()).send().code < 400:
+                        count = count + 1
+        return count
+
     #
     # Assign
     #
@@ -262,9 +932,11 @@ class OpalConnection(DSConnection):
         identifiers: str = None,
         id_name: str = None,
         asynchronous: bool = True,
+        session: RSession = None,
     ) -> DSResult:
+        rsession = self._get_rsession(session)
         builder = (
-            UriBuilder(["datashield", "session", self._get_session_id(), "symbol", symbol, "table", table])
+            UriBuilder(["datashield", "session", rsession.get_id(), "symbol", symbol, "table", table])
             .query("missings", missings)
             .query("async", asynchronous)
         )
@@ -275,66 +947,96 @@ class OpalConnection(DSConnection):
             builder.query("identifiers", identifiers)
         if id_name is not None:
             builder.query("id", id_name)
+        submitted = time.perf_counter()
         try:
             response = self._put(builder.build()).fail_on_error().send()
         except HTTPError as e:
             raise OpalDSError(e) from e
-        return OpalResult(self, rid=str(response)) if asynchronous else OpalResult(self, result=None)
+        return (
+            OpalResult(self, rid=str(response), rsession=rsession, submit_time=time.perf_counter() - submitted)
+            if asynchronous
+            else OpalResult(self, rsession=rsession, submit_time=time.perf_counter() - submitted)
+        )
 
-    def assign_resource(self, symbol: str, resource: str, asynchronous: bool = True) -> DSResult:
+    def assign_resource(
+        self, symbol: str, resource: str, asynchronous: bool = True, session: RSession = None
+    ) -> DSResult:
+        rsession = self._get_rsession(session)
         builder = UriBuilder([
             "datashield",
             "session",
-            self._get_session_id(),
+            rsession.get_id(),
             "symbol",
             symbol,
             "resource",
             resource,
         ]).query("async", asynchronous)
+        submitted = time.perf_counter()
         try:
             response = self._put(builder.build()).fail_on_error().send()
         except HTTPError as e:
             raise OpalDSError(e) from e
-        return OpalResult(self, rid=str(response)) if asynchronous else OpalResult(self, result=None)
+        return (
+            OpalResult(self, rid=str(response), rsession=rsession, submit_time=time.perf_counter() - submitted)
+            if asynchronous
+            else OpalResult(self, rsession=rsession, submit_time=time.perf_counter() - submitted)
+        )
 
-    def assign_expr(self, symbol: str, expr: str, asynchronous: bool = True) -> DSResult:
-        builder = UriBuilder(["datashield", "session", self._get_session_id(), "symbol", symbol]).query(
+    def assign_expr(self, symbol: str, expr: str, asynchronous: bool = True, session: RSession = None) -> DSResult:
+        rsession = self._get_rsession(session)
+        builder = UriBuilder(["datashield", "session", rsession.get_id(), "symbol", symbol]).query(
             "async", asynchronous
         )
+        submitted = time.perf_counter()
         try:
             response = self._put(builder.build()).content_type_rscript().content(expr).fail_on_error().send()
         except HTTPError as e:
             raise OpalDSError(e) from e
-        return OpalResult(self, rid=str(response)) if asynchronous else OpalResult(self, result=None)
+        return (
+            OpalResult(self, rid=str(response), rsession=rsession, submit_time=time.perf_counter() - submitted)
+            if asynchronous
+            else OpalResult(self, rsession=rsession, submit_time=time.perf_counter() - submitted)
+        )
 
     #
     # Aggregate
     #
 
-    def aggregate(self, expr: str, asynchronous: bool = True) -> DSResult:
-        builder = UriBuilder(["datashield", "session", self._get_session_id(), "aggregate"]).query(
-            "async", asynchronous
-        )
+    def aggregate(self, expr: str, asynchronous: bool = True, session: RSession = None) -> DSResult:
+        rsession = self._get_rsession(session)
+        builder = UriBuilder(["datashield", "session", rsession.get_id(), "aggregate"]).query("async", asynchronous)
+        submitted = time.perf_counter()
         try:
-            response = self._post(builder.build()).content_type_rscript().content(expr).fail_on_error().send()
+            response = (
+                self
+                ._post(builder.build(), priority=PRIORITY_INTERACTIVE)
+                .content_type_rscript()
+                .content(expr)
+                .fail_on_error()
+                .send()
+            )
         except HTTPError as e:
             raise OpalDSError(e) from e
-        return OpalResult(self, rid=str(response)) if asynchronous else OpalResult(self, result=response)
+        return (
+            OpalResult(self, rid=str(response), rsession=rsession, submit_time=time.perf_counter() - submitted)
+            if asynchronous
+            else OpalResult(self, result=response, rsession=rsession, submit_time=time.perf_counter() - submitted)
+        )
 
     #
     # Symbols
     #
 
-    def list_symbols(self) -> list:
-        builder = UriBuilder(["datashield", "session", self._get_session_id(), "symbols"])
+    def list_symbols(self, session: RSession = None) -> list:
+        builder = UriBuilder(["datashield", "session", self._get_session_id(session), "symbols"])
         response = self._get(builder.build()).fail_on_error().send()
         rval = response.from_json()
         if type(rval) is str:
             rval = [rval]
         return rval
 
-    def rm_symbol(self, name: str) -> None:
-        builder = UriBuilder(["datashield", "session", self._get_session_id(), "symbol", name])
+    def rm_symbol(self, name: str, session: RSession = None) -> None:
+        builder = UriBuilder(["datashield", "session", self._get_session_id(session), "symbol", name])
         self._delete(builder.build()).send()
 
     #
@@ -343,15 +1045,13 @@ class OpalConnection(DSConnection):
 
     def list_profiles(self) -> list:
         builder = UriBuilder(["datashield", "profiles"])
-        response = self._get(builder.build()).send()
-        profiles = response.from_json()
+        profiles = self._get_listing(builder.build(), fail_on_error=False)
         names = [x["name"] for x in profiles if x["enabled"]]
         return {"available": names, "current": self.profile}
 
     def list_methods(self, type: str = "aggregate") -> list:
         builder = UriBuilder(["datashield", "env", type, "methods"]).query("profile", self.profile)
-        response = self._get(builder.build()).send()
-        methods = response.from_json()
+        methods = self._get_listing(builder.build(), fail_on_error=False)
 
         def format(x):
             item = {"name": x["name"]}
@@ -422,17 +1122,129 @@ class OpalConnection(DSConnection):
     def is_async(self) -> dict:
         return {"aggregate": True, "assign_table": True, "assign_resource": True, "assign_expr": True}
 
+    @classmethod
+    def set_host_limiter(cls, url: str, limiter: RequestLimiter = None) -> None:
+        """
+        Limit the requests sent to an Opal server by all the connections to it.
+
+        :param url: The Opal server URL
+        :param limiter: The limiter, None to remove it
+        """
+        host = urlparse(url).netloc
+        with _host_limiters_lock:
+            if limiter is None:
+                _host_limiters.pop(host, None)
+            else:
+                _host_limiters[host] = limiter
+
+    @classmethod
+    def set_host_breaker(cls, url: str, breaker: CircuitBreaker = None) -> None:
+        """
+        Fail fast the requests sent to an Opal server by all the connections to it, after repeated failures.
+
+        :param url: The Opal server URL
+        :param breaker: The circuit breaker, None to remove it
+        """
+        host = urlparse(url).netloc
+        with _host_limiters_lock:
+            if breaker is None:
+                _host_breakers.pop(host, None)
+            else:
+                _host_breakers[host] = breaker
+
+    def get_limiter_stats(self) -> dict:
+        """
+        Get the metrics of the limiters of this connection and of its host.
+
+        :return: The "connection" and "host" limiter metrics, None when there is no such limiter
+        """
+        host_limiter = self._get_host_limiter()
+        return {
+            "connection": self.limiter.get_stats() if self.limiter is not None else None,
+            "host": host_limiter.get_stats() if host_limiter is not None else None,
+        }
+
+    def get_coalescing_stats(self) -> dict:
+        """
+        Get the counts of catalogue requests that were sent to the server and of the ones that shared the
+        response of an identical concurrent request.
+
+        :return: The "executed" and "coalesced" counts
+        """
+        return self._listings.get_stats()
+
+    def get_timing_report(self) -> dict:
+        """
+        Get the cumulated timings of the results fetched from this connection, to identify whether the analysis
+        is bound by the queueing of the R commands, their execution or the network (submission and result transfer).
+        Note that the submission of a synchronous operation includes its queueing and execution.
+
+        :return: The count, total, mean and max seconds of each timing component, and the "bound" component
+        """
+        with self._timings_lock:
+            report = {
+                key: {**timing, "mean": timing["total"] / timing["count"]} for key, timing in self._timings.items()
+            }
+
+        def total(key):
+            return report[key]["total"] if key in report else 0
+
+        bounds = {"queue": total("queue"), "r": total("execution"), "network": total("submit") + total("transfer")}
+        report["bound"] = max(bounds, key=bounds.get) if any(bounds.values()) else None
+        return report
+
+    def prefetch(self) -> None:
+        """
+        Retrieve the catalogues (tables, resources, profiles and methods) in background. The next listing calls
+        get the prefetched data, or wait for the prefetch in progress, instead of sending new requests. A prefetched
+        catalogue is served once and only during prefetch_ttl seconds, later calls get fresh data.
+        """
+        listings = [
+            ("/datasources", True),
+            (UriBuilder(["datashield", "profiles"]).build(), False),
+            (UriBuilder(["datashield", "env", "aggregate", "methods"]).query("profile", self.profile).build(), False),
+            (UriBuilder(["datashield", "env", "assign", "methods"]).query("profile", self.profile).build(), False),
+        ]
+
+        def prefetch_resources():
+            projects = self._fetch_listing("/projects", True)
+            # register the resources prefetches before releasing the projects listing
+            for project in projects:
+                ws = UriBuilder(["project", project["name"], "resources"]).build()
+                self._submit_prefetch(ws, True, self._fetch_listing, ws, True)
+            return projects
+
+        for ws, fail_on_error in listings:
+            self._submit_prefetch(ws, fail_on_error, self._fetch_listing, ws, fail_on_error)
+        self._submit_prefetch("/projects", True, prefetch_resources)
+
     def keep_alive(self) -> None:
         with suppress(Exception):
             self.list_symbols()
+            for rsession in self.rsessions:
+                self.list_symbols(session=rsession)
 
     def disconnect(self) -> None:
         """
         Close DataSHIELD session, and then Opal session.
         """
-        if self.rsession is not None:
-            self.rsession.close()
+        with self._prefetch_lock:
+            # prefetches still running do not submit anymore
+            self._closed = True
+            if self._prefetcher is not None:
+                self._prefetcher.shutdown(wait=False, cancel_futures=True)
+                self._prefetcher = None
+            self._prefetched = {}
+        with self._session_lock:
+            for rsession in self.rsessions:
+                rsession.close()
+            self.rsessions = []
+            self._routes = {}
+            if self.rsession is not None:
+                self.rsession.close()
         self.client.close()
+        if self.transport is not None:
+            self.transport.close()
 
     #
     # Private methods
@@ -440,90 +1252,450 @@ class OpalConnection(DSConnection):
 
     def _get_subject(self):
         if self.subject is None:
-            builder = UriBuilder(["system", "subject-profile", "_current"])
-            response = self._get(builder.build()).fail_on_error().send()
-            self.subject = response.from_json()
+            with self._subject_lock:
+                # another thread may have retrieved the subject meanwhile
+                if self.subject is None:
+                    builder = UriBuilder(["system", "subject-profile", "_current"])
+                    response = self._get(builder.build()).fail_on_error().send()
+                    self.subject = response.from_json()
         return self.subject
 
-    def _get_session_id(self) -> str:
-        self.start_session(asynchronous=False)
-        return self.rsession.get_id()
+    def _get_rsession(self, session: RSession = None) -> OpalRSession:
+        if session is None:
+            self.start_session(asynchronous=False)
+            return self.rsession
+        if session is not self.rsession and session not in self.rsessions:
+            raise OpalDSError(ValueError("R session is not managed by this connection"))
+        return session
+
+    def _new_rsession(self) -> OpalRSession:
+        return OpalRSession(
+            self.client,
+            profile=self.profile,
+            restore=self.restore,
+            verbose=self.verbose,
+            new_request=self._new_request,
+        )
 
-    def _get(self, ws) -> OpalRequest:
-        request = self.client.new_request()
+    def _get_session_id(self, session: RSession = None) -> str:
+        return self._get_rsession(session).get_id()
+
+    def _record_timings(self, timings: dict) -> None:
+        with self._timings_lock:
+            for key, value in timings.items():
+                if value is None:
+                    continue
+                timing = self._timings.setdefault(key, {"count": 0, "total": 0.0, "max": 0.0})
+                timing["count"] = timing["count"] + 1
+                timing["total"] = timing["total"] + value
+                timing["max"] = max(timing["max"], value)
+
+    def _get_listing(self, ws: str, fail_on_error: bool = True) -> any:
+        # the decoded response is shared by concurrent callers: it must be read-only
+        key = (ws, fail_on_error)
+        # the prefetched entry is taken by a single caller, the others do the request
+        with self._prefetch_lock:
+            prefetched = self._prefetched.pop(key, None)
+        if prefetched is not None:
+            future, expires = prefetched
+            # fallback to a new request if the prefetch has expired or failed
+            if time.monotonic() < expires:
+                with suppress(Exception):
+                    return future.result()
+        return self._listings.do(key, lambda: self._fetch_listing(ws, fail_on_error))
+
+    def _submit_prefetch(self, ws: str, fail_on_error: bool, func: Callable, *args) -> None:
+        with self._prefetch_lock:
+            if self._closed:
+                return
+            if self._prefetcher is None:
+                self._prefetcher = futures.ThreadPoolExecutor(
+                    max_workers=4, thread_name_prefix=f"opal-prefetch-{self.name}"
+                )
+            future = self._prefetcher.submit(func, *args)
+            self._prefetched[(ws, fail_on_error)] = (future, time.monotonic() + self.prefetch_ttl)
+
+    def _fetch_listing(self, ws: str, fail_on_error: bool) -> any:
+        request = self._get(ws, priority=PRIORITY_BULK)
+        if fail_on_error:
+            request.fail_on_error()
+        return request.send().from_json()
+
+    def _get(self, ws, priority: int = PRIORITY_NORMAL) -> OpalRequest:
+        request = self._new_request(priority)
         if self.verbose:
             request.verbose()
         return request.accept_json().get().resource(ws)
 
-    def _post(self, ws) -> OpalRequest:
-        request = self.client.new_request()
+    def _post(self, ws, priority: int = PRIORITY_NORMAL) -> OpalRequest:
+        request = self._new_request(priority)
         if self.verbose:
             request.verbose()
         return request.accept_json().post().resource(ws)
 
-    def _put(self, ws) -> OpalRequest:
-        request = self.client.new_request()
+    def _put(self, ws, priority: int = PRIORITY_NORMAL) -> OpalRequest:
+        request = self._new_request(priority)
         if self.verbose:
             request.verbose()
         return request.accept_json().put().resource(ws)
 
-    def _delete(self, ws) -> OpalRequest:
-        request = self.client.new_request()
+    def _delete(self, ws, priority: int = PRIORITY_NORMAL) -> OpalRequest:
+        request = self._new_request(priority)
         if self.verbose:
             request.verbose()
         return request.accept_json().delete().resource(ws)
 
+    def _new_request(self, priority: int = PRIORITY_NORMAL) -> OpalRequest:
+        # a request without priority is not limited
+        limiters = [] if priority is None else [x for x in [self.limiter, self._get_host_limiter()] if x is not None]
+        breaker = _host_breakers.get(urlparse(self.client.base_url).netloc)
+        return _ManagedRequest(self.client, limiters, priority, retry=self.retry, breaker=breaker)
+
+    def _get_host_limiter(self) -> RequestLimiter:
+        return _host_limiters.get(urlparse(self.client.base_url).netloc)
+
+
+# Requests limiters and circuit breakers by Opal server host
+_host_limiters = {}
+_host_breakers = {}
+_host_limiters_lock = threading.Lock()
+
 
 class OpalDriver(DSDriver):
+    # whether the catalogues are retrieved in background once connected
+    prefetch = False
+
     @classmethod
-    def new_connection(cls, args: DSLoginInfo, restore: str = None) -> DSConnection:
+    def new_connection(
+        cls, args: DSLoginInfo, restore: str = None, prefetch: bool = None, transport: BaseAdapter = None
+    ) -> DSConnection:
         namedArgs = Namespace(opal=args.url, user=args.user, password=args.password, token=args.token)
         loginInfo = OpalClient.LoginInfo.parse(namedArgs)
-        conn = OpalConnection(args.name, loginInfo, args.profile, restore)
+        conn = OpalConnection(args.name, loginInfo, args.profile, restore, transport=transport)
         if not conn.check_user():
             creds = f"user {args.user}" if args.user else "token"
             raise OpalDSError(ValueError(f"Failed to authenticate on {args.url} with {creds}"))
+        if cls.prefetch if prefetch is None else prefetch:
+            conn.prefetch()
         return conn
 
 
 class OpalResult(DSResult):
-    def __init__(self, conn: OpalConnection, rid: str = None, result: any = None):
+    def __init__(
+        self,
+        conn: OpalConnection,
+        rid: str = None,
+        result: any = None,
+        rsession: OpalRSession = None,
+        cleanup: bool = None,
+        submit_time: float = None,
+    ):
         self.conn = conn
+        # the R session in which the command was submitted, defaults to the connection's one
+        self.rsession = conn.rsession if rsession is None else rsession
         self.rid = rid
         self.result = result
         self.cmd = None
+        # remove the server-side R command once its result is fetched, defaults to the connection's setting
+        self.cleanup = conn.cleanup_commands if cleanup is None else cleanup
+        self.fetched = False
+        # seconds spent in each step of the command lifecycle, None when unknown
+        self.timings = {"submit": submit_time, "queue": None, "execution": None, "transfer": None, "decode": None}
+        # serializes the waiting and the fetching of the result
+        self._lock = threading.RLock()
 
     def is_completed(self) -> bool:
-        if self.rid is None:
+        if self.rid is None or self.cmd:
             return True
         else:
             # check if R command is completed
-            builder = UriBuilder(["datashield", "session", self.conn._get_session_id(), "command", self.rid]).query(
-                "wait", False
-            )
-            response = self.conn._get(builder.build()).send()
-            cmd = response.from_json()
-            status = (cmd["status"] == "COMPLETED" or cmd["status"] == "FAILED") if "status" in cmd else False
+            cmd = self._get_command(wait=False)
+            status = "status" in cmd and self._is_final(cmd)
             if status:
                 # store final state
                 self.cmd = cmd
             return status
 
-    def fetch(self) -> any:
-        if self.rid is None:
-            return self.result.from_json() if type(self.result) is OpalResponse else None
+    def fetch(self, as_frame: bool = False) -> any:
+        """
+        Fetch the result of the assignment or aggregation operation.
+
+        :param as_frame: Whether the result is converted to a pandas DataFrame
+        :return: The result, decoded from JSON or as a DataFrame
+        """
+        self._fetch()
+        return _to_frame(self.result) if as_frame else self.result
+
+    def _fetch(self) -> None:
+        if self.fetched:
+            return
+        with self._lock:
+            # another thread may have fetched the result meanwhile
+            if self.fetched:
+                return
+            if self.rid is None:
+                # decode once and release the raw response
+                started = time.perf_counter()
+                self.result = self.result.from_json() if type(self.result) is OpalResponse else None
+                self.timings["decode"] = time.perf_counter() - started
+            else:
+                self.wait()
+                if "status" in self.cmd and self.cmd["status"] == "FAILED":
+                    msg = self.cmd.get("error", "<no message>")
+                    raise OpalDSError(ValueError(f"Command {self.rid} failed on {self.conn.name}: {msg}"))
+
+                builder = UriBuilder(["datashield", "session", self.rsession.get_id(), "command", self.rid, "result"])
+                started = time.perf_counter()
+                response = self.conn._get(builder.build(), priority=PRIORITY_INTERACTIVE).send()
+                received = time.perf_counter()
+                self.result = response.from_json() if self.cmd["withResult"] else None
+                self.timings["transfer"] = received - started
+                self.timings["decode"] = time.perf_counter() - received
+                self.timings["queue"] = _elapsed(self.cmd.get("createDate"), self.cmd.get("startDate"))
+                self.timings["execution"] = _elapsed(self.cmd.get("startDate"), self.cmd.get("endDate"))
+                if self.cleanup:
+                    self._remove_command()
+            self.fetched = True
+            self.conn._record_timings(self.timings)
+
+    def wait(self) -> None:
+        """
+        Block until the R command is completed (successfully or not), using server-side long polling.
+        """
+        if self.rid is None or self.cmd:
+            return
+        with self._lock:
+            # only one thread polls the server, the others wait for its outcome
+            while not self.cmd:
+                cmd = self._get_command(wait=True)
+                if self._is_final(cmd):
+                    # store final state
+                    self.cmd = cmd
+
+    def _poll(self, deadline: float = None) -> bool:
+        """
+        Long poll the R command until it is completed or the deadline is reached, each request being bounded so that
+        none is left waiting on the server after the deadline. The result lock is not held, so that a poll can be
+        abandoned at any time.
+
+        :param deadline: The time.monotonic() deadline, no limit if None
+        :return: Whether the R command is completed
+        """
+        while not self.cmd:
+            step = _LONG_POLL_TIMEOUT if deadline is None else min(_LONG_POLL_TIMEOUT, deadline - time.monotonic())
+            if step <= 0:
+                return False
+            try:
+                cmd = self._get_command(wait=True, timeout=step)
+            except ReadTimeout:
+                continue
+            if self._is_final(cmd):
+                self.cmd = cmd
+        return True
+
+    def _get_command(self, wait: bool, timeout: float = None) -> dict:
+        builder = UriBuilder(["datashield", "session", self.rsession.get_id(), "command", self.rid]).query("wait", wait)
+        # long polling is not limited, as it mostly waits for the server
+        request = self.conn._get(builder.build(), priority=None if wait else PRIORITY_INTERACTIVE)
+        if timeout is not None:
+            request.timeout(timeout)
+        return request.send().from_json()
+
+    def _remove_command(self) -> None:
+        builder = UriBuilder(["datashield", "session", self.rsession.get_id(), "command", self.rid])
+        # the command may have been removed already
+        with suppress(Exception):
+            self.conn._delete(builder.build()).send()
+
+    @staticmethod
+    def _is_final(cmd: dict) -> bool:
+        # a command without status cannot be polled any further
+        return "status" not in cmd or cmd["status"] == "COMPLETED" or cmd["status"] == "FAILED"
+
+
+#
+# Data frames
+#
+
+
+def _import_pandas():
+    try:
+        import pandas
+
+        return pandas
+    except ImportError as e:
+        raise OpalDSError(ImportError("pandas is required for decoding as a data frame")) from e
+
+
+def _set_cell(columns: dict, name: str, index: int, value: any, size: int) -> None:
+    # columns are allocated on first value, missing cells are None
+    column = columns.get(name)
+    if column is None:
+        column = [None] * size
+        columns[name] = column
+    column[index] = value
+
+
+def _variables_to_frame(variables: list) -> "pandas.DataFrame":
+    """
+    Build the data frame of the variables, with a column per variable property and per attribute, named as
+    "[namespace::]name[:locale]". The categories column holds the list of the category names.
+    """
+    pandas = _import_pandas()
+    size = len(variables)
+    columns = {}
+    for index, variable in enumerate(variables):
+        for key, value in variable.items():
+            if key == "attributes":
+                for attribute in value:
+                    name = attribute["name"]
+                    if "namespace" in attribute:
+                        name = f"{attribute['namespace']}::{name}"
+                    if "locale" in attribute:
+                        name = f"{name}:{attribute['locale']}"
+                    _set_cell(columns, name, index, attribute.get("value"), size)
+            elif key == "categories":
+                _set_cell(columns, key, index, [category["name"] for category in value], size)
+            else:
+                _set_cell(columns, key, index, value, size)
+    return pandas.DataFrame(columns)
+
+
+def _hits_to_frame(result: dict) -> "pandas.DataFrame":
+    """
+    Build the data frame of the search hits, with a column for the identifier and per field. The total number of hits
+    is in the "total_hits" attribute of the data frame.
+    """
+    pandas = _import_pandas()
+    hits = result.get("hits", [])
+    size = len(hits)
+    columns = {"identifier": [None] * size}
+    for index, hit in enumerate(hits):
+        columns["identifier"][index] = hit.get("identifier")
+        # the fields are in the ItemFieldsDto extension of the hit
+        item = hit.get("Search.ItemFieldsDto.item", hit)
+        for field in item.get("fields", []):
+            _set_cell(columns, field["key"], index, field.get("value"), size)
+    frame = pandas.DataFrame(columns)
+    frame.attrs["total_hits"] = result.get("totalHits", size)
+    return frame
+
+
+def _to_frame(value: any):
+    """
+    Build the data frame of a decoded result: a list of records (one per row), a dictionary of columns or
+    a dictionary of scalars (single row).
+    """
+    pandas = _import_pandas()
+    if value is None:
+        return pandas.DataFrame()
+    if isinstance(value, list):
+        if not all(isinstance(record, dict) for record in value):
+            return pandas.DataFrame({"value": value})
+        # union of the record keys, in order of appearance, then one pass per column
+        keys = {}
+        for record in value:
+            if not keys.keys() >= record.keys():
+                keys.update(dict.fromkeys(record))
+        return pandas.DataFrame({key: [record.get(key) for record in value] for key in keys})
+    if isinstance(value, dict):
+        if all(isinstance(column, list) for column in value.values()):
+            lengths = {len(column) for column in value.values()}
+            if len(lengths) <= 1:
+                return pandas.DataFrame(value)
+        return pandas.DataFrame({key: [cell] for key, cell in value.items()})
+    return pandas.DataFrame({"value": [value]})
+
+
+#
+# Results utils
+#
+
+
+def _elapsed(start: str | int, end: str | int) -> float:
+    """Seconds between two server dates, None if one of them is missing or cannot be parsed."""
+    if start is None or end is None:
+        return None
+    try:
+        return (_parse_date(end) - _parse_date(start)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_date(value: str | int) -> datetime:
+    if isinstance(value, int | float):
+        # epoch milliseconds
+        return datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%f%z", "%Y-%m-%dT%H:%M:%S%z"):
+        with suppress(ValueError):
+            return datetime.strptime(value, fmt)
+    return datetime.fromisoformat(value)
+
+
+# Maximum seconds of a long polling request, sent again while the R command is not completed
+_LONG_POLL_TIMEOUT = 10.0
+
+# Maximum number of concurrent long polling requests of as_completed()
+_MAX_POLLERS = 64
+
+
+def as_completed(results: list[OpalResult], timeout: float = None) -> Iterator[OpalResult]:
+    """
+    Iterate over the results (possibly from different connections) as soon as their R command is completed.
+    The pending results are long polled in parallel, each request being bounded by the remaining time, so that no
+    request is left waiting on a server after the timeout. When the iteration is stopped early, the polls that are
+    still running are abandoned: they end by themselves within the timeout, or within 10 seconds without timeout.
+
+    :param results: The results of asynchronous assignment or aggregation operations
+    :param timeout: The maximum number of seconds to wait for all the results, no limit if None
+    :return: An iterator of the completed results, in the order of their completion
+    :raises TimeoutError: If some results are not completed before the timeout. These results are left untouched,
+        they can be awaited again or fetched later.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    pending = []
+    for result in results:
+        if result.rid is None or result.cmd:
+            yield result
         else:
-            if not self.cmd:
-                # get the result of R command by its id
-                builder = UriBuilder(["datashield", "session", self.conn._get_session_id(), "command", self.rid]).query(
-                    "wait", True
-                )
-                response = self.conn._get(builder.build()).send()
-                self.cmd = response.from_json()
-            if "status" in self.cmd and self.cmd["status"] == "FAILED":
-                msg = self.cmd.get("error", "<no message>")
-                raise OpalDSError(ValueError(f"Command {self.rid} failed on {self.conn.name}: {msg}"))
-
-            builder = UriBuilder(["datashield", "session", self.conn._get_session_id(), "command", self.rid, "result"])
-            response = self.conn._get(builder.build()).send()
-            return response.from_json() if self.cmd["withResult"] else None
+            pending.append(result)
+    if not pending:
+        return
+    executor = futures.ThreadPoolExecutor(max_workers=min(len(pending), _MAX_POLLERS), thread_name_prefix="opal-poll")
+    try:
+        polls = {executor.submit(result._poll, deadline): result for result in pending}
+        completed = 0
+        # the polls end by themselves at the deadline, the margin covers the end of their last request
+        wait_timeout = None if deadline is None else max(0, deadline - time.monotonic()) + 1
+        with suppress(futures.TimeoutError):
+            for poll in futures.as_completed(polls, timeout=wait_timeout):
+                if poll.result():
+                    completed = completed + 1
+                    yield polls[poll]
+        if completed < len(pending):
+            raise TimeoutError(f"{len(pending) - completed} result(s) not completed after {timeout}s")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def wait_any(results: list[OpalResult], timeout: float = None) -> tuple[list[OpalResult], list[OpalResult]]:
+    """
+    Wait for at least one of the results (possibly from different connections) to be completed.
+    The completion is checked as in as_completed(): the polls of the not completed results are abandoned, and
+    end by themselves within the timeout.
+
+    :param results: The results of asynchronous assignment or aggregation operations
+    :param timeout: The maximum number of seconds to wait, no limit if None
+    :return: The lists of the completed and of the not completed results, the latter being empty only if all
+        the results are completed; on timeout, all the results are in the not completed list
+    """
+    done = []
+    iterator = as_completed(results, timeout=timeout)
+    try:
+        done.append(next(iterator))
+    except (StopIteration, TimeoutError):
+        pass
+    finally:
+        iterator.close()
+    done = done + [result for result in results if result not in done and (result.rid is None or result.cmd)]
+    return done, [result for result in results if result not in done]
@@ -0,0 +1,79 @@
+"""
+Benchmark of the data frame decoding of the variables dictionary and of the tabular aggregates, compared with the
+conversion of the list of dictionaries row by row.
+
+Requires pandas. Usage: python examples/benchmark_frame.py [number of variables] [number of rows]
+"""
+
+import sys
+import timeit
+
+import pandas
+
+from datashield_opal.impl import _to_frame, _variables_to_frame
+
+
+def make_variables(count: int) -> list:
+    return [
+        {
+            "name": f"VAR_{i}",
+            "entityType": "Participant",
+            "valueType": "integer" if i % 2 else "decimal",
+            "isRepeatable": False,
+            "index": i,
+            "unit": "mmol/L",
+            "attributes": [
+                {"name": "label", "locale": "en", "value": f"Variable {i}"},
+                {"name": "label", "locale": "fr", "value": f"Variable {i}"},
+                {"namespace": "maelstrom", "name": "area", "value": "Laboratory_measures"},
+            ],
+            "categories": [{"name": str(c), "isMissing": c > 2} for c in range(4)],
+        }
+        for i in range(count)
+    ]
+
+
+def make_rows(count: int) -> list:
+    return [{"id": str(i), "age": 20 + i % 60, "bmi": 18.5 + (i % 200) / 10, "gender": i % 2} for i in range(count)]
+
+
+def variables_row_by_row(variables: list) -> pandas.DataFrame:
+    # the usual consumer conversion: one flattened dictionary per variable
+    rows = []
+    for variable in variables:
+        row = {key: value for key, value in variable.items() if key not in ["attributes", "categories"]}
+        for attribute in variable.get("attributes", []):
+            name = attribute["name"]
+            if "namespace" in attribute:
+                name = f"{attribute['namespace']}::{name}"
+            if "locale" in attribute:
+                name = f"{name}:{attribute['locale']}"
+            row[name] = attribute.get("value")
+        row["categories"] = [category["name"] for category in variable.get("categories", [])]
+        rows.append(row)
+    return pandas.DataFrame(rows)
+
+
+def rows_row_by_row(rows: list) -> pandas.DataFrame:
+    return pandas.DataFrame([dict(row) for row in rows])
+
+
+def bench(label: str, func, data, number: int = 5) -> None:
+    seconds = min(timeit.repeat(lambda: func(data), number=number, repeat=3)) / number
+    print(f"{label:<40} {seconds * 1000:10.2f} ms")
+
+
+if __name__ == "__main__":
+    n_variables = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    n_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    variables = make_variables(n_variables)
+    rows = make_rows(n_rows)
+    assert variables_row_by_row(variables).shape == _variables_to_frame(variables).shape
+    assert rows_row_by_row(rows).shape == _to_frame(rows).shape
+
+    print(f"Variables dictionary ({n_variables} variables)")
+    bench("  list of dicts, row by row", variables_row_by_row, variables)
+    bench("  as_frame=True", _variables_to_frame, variables)
+    print(f"Tabular aggregate ({n_rows} rows)")
+    bench("  list of dicts, row by row", rows_row_by_row, rows)
+    bench("  as_frame=True", _to_frame, rows)
@@ -1,5 +1,6 @@
 import pytest
 from datashield import DSSession, DSLoginBuilder, DSError
+from datashield_opal import as_completed, wait_any
 
 
 class TestClass:
@@ -81,3 +82,19 @@ class TestClass:
         except DSError as e:
             print(self.session.get_errors())
             raise ValueError("Failed to assign resource") from e
+
+    @pytest.mark.integration
+    def test_as_completed(self):
+        try:
+            self.session.assign_table("df", table="CNSIM.CNSIM1", asynchronous=False)
+            results = [conn.aggregate("meanDS(df$LAB_GLUC)", asynchronous=True) for conn in self.session.conns]
+            done, pending = wait_any(results, timeout=30)
+            assert len(done) + len(pending) == 2
+            assert len(done) > 0
+            means = [res.fetch() for res in as_completed(results, timeout=30)]
+            assert len(means) == 2
+            for mean in means:
+                assert "EstimatedMean" in mean
+        except DSError as e:
+            print(self.session.get_errors())
+            raise ValueError("Failed to aggregate") from e
@@ -0,0 +1,93 @@
+from datashield_opal.impl import _hits_to_frame, _to_frame, _variables_to_frame
+import pytest
+
+pandas = pytest.importorskip("pandas")
+
+
+class TestClass:
+    def test_variables_to_frame(self):
+        variables = [
+            {
+                "name": "LAB_TSC",
+                "entityType": "Participant",
+                "valueType": "decimal",
+                "isRepeatable": False,
+                "index": 0,
+                "unit": "mmol/L",
+                "attributes": [
+                    {"name": "label", "locale": "en", "value": "Total Serum Cholesterol"},
+                    {"namespace": "maelstrom", "name": "area", "value": "Laboratory_measures"},
+                ],
+            },
+            {
+                "name": "GENDER",
+                "entityType": "Participant",
+                "valueType": "integer",
+                "isRepeatable": False,
+                "index": 1,
+                "attributes": [{"name": "label", "locale": "en", "value": "Gender"}],
+                "categories": [{"name": "0", "isMissing": False}, {"name": "1", "isMissing": False}],
+            },
+        ]
+        frame = _variables_to_frame(variables)
+        assert list(frame["name"]) == ["LAB_TSC", "GENDER"]
+        assert list(frame["label:en"]) == ["Total Serum Cholesterol", "Gender"]
+        # missing cells
+        assert frame["maelstrom::area"][0] == "Laboratory_measures"
+        assert list(frame["maelstrom::area"].isna()) == [False, True]
+        assert list(frame["unit"].isna()) == [False, True]
+        assert frame["categories"][1] == ["0", "1"]
+        assert frame["categories"][0] is None
+        assert _variables_to_frame([]).empty
+
+    def test_hits_to_frame(self):
+        result = {
+            "totalHits": 3,
+            "hits": [
+                {
+                    "identifier": "CNSIM:CNSIM1:LAB_TSC",
+                    "Search.ItemFieldsDto.item": {
+                        "fields": [
+                            {"key": "project", "value": "CNSIM"},
+                            {"key": "name", "value": "LAB_TSC"},
+                            {"key": "label-en", "value": "Total Serum Cholesterol"},
+                        ]
+                    },
+                },
+                {
+                    "identifier": "CNSIM:CNSIM2:LAB_TSC",
+                    "Search.ItemFieldsDto.item": {
+                        "fields": [{"key": "project", "value": "CNSIM"}, {"key": "name", "value": "LAB_TSC"}]
+                    },
+                },
+                # fields without the extension
+                {"identifier": "CNSIM:CNSIM3:LAB_TSC", "fields": [{"key": "name", "value": "LAB_TSC"}]},
+            ],
+        }
+        frame = _hits_to_frame(result)
+        assert list(frame.columns) == ["identifier", "project", "name", "label-en"]
+        assert list(frame["name"]) == ["LAB_TSC"] * 3
+        assert frame["label-en"][0] == "Total Serum Cholesterol"
+        assert list(frame["label-en"].isna()) == [False, True, True]
+        assert frame.attrs["total_hits"] == 3
+        frame = _hits_to_frame({"totalHits": 0})
+        assert list(frame.columns) == ["identifier"]
+        assert frame.attrs["total_hits"] == 0
+
+    def test_to_frame(self):
+        # records, with the union of their keys
+        frame = _to_frame([{"id": "1", "age": 30}, {"id": "2", "bmi": 21.5}])
+        assert list(frame.columns) == ["id", "age", "bmi"]
+        assert frame.shape == (2, 3)
+        assert frame["bmi"][1] == 21.5
+        # columns
+        frame = _to_frame({"mean": [2.1, 3.4], "n": [10, 12]})
+        assert frame.shape == (2, 2)
+        # columns of different lengths and scalars are a single row
+        assert _to_frame({"mean": [2.1, 3.4], "n": [10]}).shape == (1, 2)
+        frame = _to_frame({"EstimatedMean": 5.87, "Nmissing": 0, "Nvalid": 2163, "Ntotal": 2163})
+        assert list(frame.iloc[0]) == [5.87, 0, 2163, 2163]
+        # values
+        assert list(_to_frame([1, 2, 3])["value"]) == [1, 2, 3]
+        assert list(_to_frame("x")["value"]) == ["x"]
+        assert _to_frame(None).empty
@@ -1,4 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import gzip
+import json
 from datashield import DSError, DSLoginBuilder, DSSession
+from datashield_opal import (
+    CircuitBreaker,
+    OpalDriver,
+    RecordingTransport,
+    ReplayTransport,
+    RequestLimiter,
+    RetryPolicy,
+)
+from datashield_opal.impl import OpalConnection
 import pytest
 import time
 
@@ -228,6 +241,203 @@ class TestClass:
             print(value)
         print(exc_info.value.get_error())
 
+    @pytest.mark.integration
+    def test_cleanup_commands(self):
+        conn = self.conn
+        try:
+            conn.assign_table("x", "CNSIM.CNSIM1", asynchronous=False)
+            res = conn.aggregate("meanDS(x$LAB_GLUC)", asynchronous=True)
+            res.cleanup = True
+            mean = res.fetch()
+            assert "EstimatedMean" in mean
+            # result is kept once fetched
+            assert res.fetch() == mean
+
+            res = conn.aggregate("meanDS(x$LAB_GLUC)", asynchronous=True)
+            self._do_wait(res)
+            assert conn.purge_commands() >= 1
+            conn.rm_symbol("x")
+        except DSError as e:
+            print(e.get_error())
+            raise ValueError("Cleanup commands test failed") from e
+
+    @pytest.mark.integration
+    def test_sessions(self):
+        conn = self.conn
+        try:
+            sessions = conn.start_sessions(2)
+            assert len(sessions) == 2
+            assert sessions[0] is conn.get_session()
+            assert conn.route_session("x") is conn.route_session("x")
+            conn.assign_expr("x", "c(1, 2, 3)", asynchronous=False, session=sessions[1])
+            assert "x" in conn.list_symbols(session=sessions[1])
+            assert "x" not in conn.list_symbols()
+            res = conn.assign_expr("y", "c(1, 2, 3)", asynchronous=True, session=sessions[1])
+            self._do_wait(res)
+            assert res.fetch() is None
+            assert "y" in conn.list_symbols(session=sessions[1])
+            conn.rm_symbol("x", session=sessions[1])
+            conn.rm_symbol("y", session=sessions[1])
+        except DSError as e:
+            print(e.get_error())
+            raise ValueError("Sessions test failed") from e
+
+    @pytest.mark.integration
+    def test_concurrent_aggregates(self):
+        url = "https://opal-demo.obiba.org"
+        logins = DSLoginBuilder().add("server1", url, "dsuser", "P@ssw0rd").build()
+        # fresh connection, without R session yet
+        conn = OpalDriver.new_connection(logins[0])
+        try:
+            # concurrent lazy start of the R session
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                symbols = list(executor.map(lambda i: conn.list_symbols(), range(8)))
+            assert symbols == [[]] * 8
+            assert len(conn.get_sessions()) == 1
+            conn.assign_table("x", "CNSIM.CNSIM1", asynchronous=False)
+
+            def do_aggregate(i):
+                res = conn.aggregate("meanDS(x$LAB_GLUC)", asynchronous=i % 2 == 0)
+                return res.fetch()
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                means = list(executor.map(do_aggregate, range(32)))
+            assert len(means) == 32
+            for mean in means:
+                assert "EstimatedMean" in mean
+            assert len(conn.get_sessions()) == 1
+        except DSError as e:
+            print(e.get_error())
+            raise ValueError("Concurrent aggregates test failed") from e
+        finally:
+            conn.disconnect()
+
+    @pytest.mark.integration
+    def test_timings(self):
+        conn = self.conn
+        try:
+            conn.assign_table("x", "CNSIM.CNSIM1", asynchronous=False)
+            res = conn.aggregate("meanDS(x$LAB_GLUC)", asynchronous=True)
+            res.fetch()
+            for key in ["submit", "queue", "execution", "transfer", "decode"]:
+                assert key in res.timings
+            assert res.timings["submit"] is not None
+            assert res.timings["transfer"] is not None
+            report = conn.get_timing_report()
+            assert report["decode"]["count"] >= 2
+            assert report["bound"] in ["queue", "r", "network"]
+            conn.rm_symbol("x")
+        except DSError as e:
+            print(e.get_error())
+            raise ValueError("Timings test failed") from e
+
+    @pytest.mark.integration
+    def test_prefetch(self):
+        url = "https://opal-demo.obiba.org"
+        logins = DSLoginBuilder().add("server1", url, "dsuser", "P@ssw0rd").build()
+        conn = OpalDriver.new_connection(logins[0], prefetch=True)
+        try:
+            assert "CNSIM.CNSIM1" in conn.list_tables()
+            assert "RSRC.CNSIM1" in conn.list_resources()
+            assert conn.list_profiles()["current"] == "default"
+            assert "meanDS" in [x["name"] for x in conn.list_methods(type="aggregate")]
+            # prefetched catalogue is served once
+            assert "CNSIM.CNSIM1" in conn.list_tables()
+        finally:
+            conn.disconnect()
+
+    @pytest.mark.integration
+    def test_limiter(self):
+        conn = self.conn
+        conn.limiter = RequestLimiter(max_in_flight=2, rate=10)
+        try:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                profiles = list(executor.map(lambda i: conn.list_methods(type="aggregate"), range(8)))
+            assert len(profiles) == 8
+            stats = conn.get_limiter_stats()
+            assert stats["connection"]["requests"] > 0
+            assert stats["connection"]["in_flight"] == 0
+            assert stats["connection"]["queued"] == 0
+            assert stats["host"] is None
+        finally:
+            conn.limiter = None
+
+    @pytest.mark.integration
+    def test_retry_and_breaker(self):
+        conn = self.conn
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=1)
+        conn.retry = RetryPolicy(max_retries=2, backoff=0.1)
+        OpalConnection.set_host_breaker("https://opal-demo.obiba.org", breaker)
+        try:
+            assert "CNSIM.CNSIM1" in conn.list_tables()
+            assert breaker.get_state() == CircuitBreaker.CLOSED
+            # client errors are not retried and do not open the circuit
+            assert not conn.has_table("CNSIM.UNKNOWN")
+            assert breaker.get_state() == CircuitBreaker.CLOSED
+        finally:
+            conn.retry = None
+            OpalConnection.set_host_breaker("https://opal-demo.obiba.org", None)
+
+    @pytest.mark.integration
+    def test_record_replay(self, tmp_path):
+        url = "https://opal-demo.obiba.org"
+        logins = DSLoginBuilder().add("server1", url, "dsuser", "P@ssw0rd").build()
+        path = str(tmp_path / "exchanges.jsonl.gz")
+
+        def workload(conn):
+            tables = conn.list_tables()
+            conn.assign_table("x", "CNSIM.CNSIM1", asynchronous=False)
+            mean = conn.aggregate("meanDS(x$LAB_GLUC)", asynchronous=True).fetch()
+            return tables, mean
+
+        conn = OpalDriver.new_connection(logins[0], transport=RecordingTransport(path))
+        try:
+            recorded = workload(conn)
+            headers = conn.client.session.headers
+            # the credentials, without the authentication scheme, and the session cookies
+            secrets = [headers[name].split(" ")[-1] for name in ["Authorization", "X-Opal-Auth"] if name in headers]
+            secrets = secrets + [cookie.value for cookie in conn.client.session.cookies]
+        finally:
+            conn.disconnect()
+        assert secrets
+        with gzip.open(path, "rt") as file:
+            exchanges = [json.loads(line) for line in file]
+        for exchange in exchanges:
+            # the secrets are neither in the recorded headers nor in the decoded contents
+            assert not {name.lower() for name in exchange["headers"]} & {"set-cookie", "cookie", "authorization"}
+            content = base64.b64decode(exchange["content"]).decode("utf-8", "replace") if exchange["content"] else ""
+            recorded_text = json.dumps(exchange) + content
+            assert "opalsid" not in recorded_text.lower()
+            for secret in secrets:
+                assert secret not in recorded_text
+
+        conn = OpalDriver.new_connection(logins[0], transport=ReplayTransport(path, latency_scale=0))
+        try:
+            assert workload(conn) == recorded
+        finally:
+            conn.disconnect()
+
+    @pytest.mark.integration
+    def test_as_frame(self):
+        pytest.importorskip("pandas")
+        conn = self.conn
+        variables = conn.list_table_variables("CNSIM.CNSIM1", as_frame=True)
+        assert "LAB_TSC" in list(variables["name"])
+        assert len(variables) == len(conn.list_table_variables("CNSIM.CNSIM1"))
+        hits = conn.search_variables("LAB_TSC", as_frame=True)
+        assert len(hits) > 0
+        assert "identifier" in hits.columns
+        assert len(hits.columns) > 1
+        try:
+            conn.assign_table("x", "CNSIM.CNSIM1", asynchronous=False)
+            mean = conn.aggregate("meanDS(x$LAB_GLUC)", asynchronous=True).fetch(as_frame=True)
+            assert len(mean) == 1
+            assert "EstimatedMean" in mean.columns
+            conn.rm_symbol("x")
+        except DSError as e:
+            print(e.get_error())
+            raise ValueError("As frame test failed") from e
+
     def _do_wait(self, res, secs=10):
         count = 0
         while not res.is_completed():
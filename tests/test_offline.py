@@ -0,0 +1,493 @@
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import base64
+import gzip
+import json
+import threading
+import time
+import pytest
+from obiba_opal.core import HTTPError, OpalClient
+from requests import ConnectionError as RequestsConnectionError, ReadTimeout, Response
+from requests.adapters import BaseAdapter
+from datashield_opal import as_completed, wait_any
+from datashield_opal.impl import (
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_NORMAL,
+    CircuitBreaker,
+    OpalConnection,
+    OpalDSError,
+    OpalResult,
+    OpalUnavailableError,
+    ReplayTransport,
+    RequestLimiter,
+    RetryPolicy,
+)
+
+
+class FakeOpalAdapter(BaseAdapter):
+    """
+    Transport that answers the requests with handlers by method and path, without any server.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.handlers = {("GET", "/system/subject-profile/_current"): lambda request: (200, {"principal": "dsuser"})}
+        self.calls = []
+        self.timeouts = []
+
+    def send(self, request, **kwargs):
+        path = urlparse(request.url).path.removeprefix("/ws")
+        self.calls.append((request.method, path))
+        self.timeouts.append(kwargs.get("timeout"))
+        # the handlers can simulate long polling up to the request timeout
+        request.timeout = kwargs.get("timeout")
+        handler = self.handlers.get((request.method, path))
+        status, body = handler(request) if handler else (404, {"status": "Not Found"})
+        response = Response()
+        response.status_code = status
+        response._content = json.dumps(body).encode("utf-8")
+        response.headers["Content-Type"] = "application/json"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+    def count(self, method, path):
+        return self.calls.count((method, path))
+
+
+class TestClass:
+    def setup_method(self, method):
+        self.url = f"http://{method.__name__.replace('_', '-')}.opal.test"
+        self.adapter = FakeOpalAdapter()
+
+    def _connect(self) -> OpalConnection:
+        args = Namespace(opal=self.url, user="dsuser", password="P@ssw0rd", token=None)
+        return OpalConnection("server1", OpalClient.LoginInfo.parse(args), transport=self.adapter)
+
+    def test_coalescing(self):
+        release = threading.Event()
+
+        def datasources(request):
+            # hold the first request until all the others are waiting for it
+            release.wait(5)
+            return 200, [{"name": "CNSIM", "table": ["CNSIM1", "CNSIM2"]}]
+
+        self.adapter.handlers["GET", "/datasources"] = datasources
+        conn = self._connect()
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            calls = [executor.submit(conn.list_tables) for _ in range(16)]
+            deadline = time.monotonic() + 5
+            while conn.get_coalescing_stats()["coalesced"] < 15:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            release.set()
+            tables = [call.result() for call in calls]
+        assert tables == [["CNSIM.CNSIM1", "CNSIM.CNSIM2"]] * 16
+        stats = conn.get_coalescing_stats()
+        assert stats["executed"] == 1
+        assert stats["coalesced"] == 15
+        assert self.adapter.count("GET", "/datasources") == 1
+        # next call is executed again
+        conn.list_tables()
+        assert self.adapter.count("GET", "/datasources") == 2
+
+    def test_prefetch_ttl(self):
+        self.adapter.handlers["GET", "/datasources"] = lambda request: (200, [{"name": "CNSIM", "table": ["CNSIM1"]}])
+        conn = self._connect()
+        conn.prefetch()
+        conn._prefetched["/datasources", True][0].result(timeout=5)
+        assert conn.list_tables() == ["CNSIM.CNSIM1"]
+        assert self.adapter.count("GET", "/datasources") == 1
+        # expired prefetch is not served
+        conn.prefetch_ttl = 0
+        conn.prefetch()
+        conn._prefetched["/datasources", True][0].result(timeout=5)
+        assert conn.list_tables() == ["CNSIM.CNSIM1"]
+        assert self.adapter.count("GET", "/datasources") == 3
+        conn.disconnect()
+
+    def test_prefetch_disconnect(self):
+        release = threading.Event()
+
+        def projects(request):
+            release.wait(5)
+            return 200, [{"name": "RSRC"}]
+
+        self.adapter.handlers["GET", "/projects"] = projects
+        self.adapter.handlers["GET", "/project/RSRC/resources"] = lambda request: (200, [{"name": "CNSIM1"}])
+        conn = self._connect()
+        conn.prefetch()
+        future = conn._prefetched["/projects", True][0]
+        deadline = time.monotonic() + 5
+        while self.adapter.count("GET", "/projects") == 0:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        conn.disconnect()
+        release.set()
+        # the running prefetch completes without submitting the resources prefetch
+        assert future.result(timeout=5) == [{"name": "RSRC"}]
+        assert self.adapter.count("GET", "/project/RSRC/resources") == 0
+        assert conn._prefetched == {}
+        conn.prefetch()
+        assert conn._prefetched == {}
+
+    def test_limiter_in_flight(self):
+        limiter = RequestLimiter(max_in_flight=3)
+        lock = threading.Lock()
+        counts = {"current": 0, "max": 0}
+
+        def request(i):
+            with limiter.acquire():
+                with lock:
+                    counts["current"] = counts["current"] + 1
+                    counts["max"] = max(counts["max"], counts["current"])
+                time.sleep(0.02)
+                with lock:
+                    counts["current"] = counts["current"] - 1
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(request, range(16)))
+        assert counts["max"] == 3
+        stats = limiter.get_stats()
+        assert stats["requests"] == 16
+        assert stats["in_flight"] == 0
+        assert stats["queued"] == 0
+        assert stats["max_queued"] > 1
+
+    def test_limiter_rate(self):
+        limiter = RequestLimiter(rate=20, burst=1)
+        started = time.monotonic()
+        for _ in range(6):
+            with limiter.acquire():
+                pass
+        # first request uses the burst token, the next 5 wait 1/20 s each
+        assert time.monotonic() - started >= 0.2
+
+    def test_limiter_priority(self):
+        limiter = RequestLimiter(max_in_flight=1)
+        served = []
+
+        def request(priority):
+            with limiter.acquire(priority):
+                served.append(priority)
+
+        slot = limiter.acquire(PRIORITY_NORMAL)
+        slot.__enter__()
+        threads = []
+        for priority in [PRIORITY_BULK, PRIORITY_NORMAL, PRIORITY_INTERACTIVE]:
+            thread = threading.Thread(target=request, args=(priority,))
+            thread.start()
+            threads.append(thread)
+            deadline = time.monotonic() + 5
+            while limiter.get_stats()["queued"] < len(threads):
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+        assert limiter.get_stats()["queued_by_priority"] == {
+            PRIORITY_BULK: 1,
+            PRIORITY_NORMAL: 1,
+            PRIORITY_INTERACTIVE: 1,
+        }
+        slot.__exit__(None, None, None)
+        for thread in threads:
+            thread.join(5)
+        assert served == [PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK]
+
+    def test_retry(self):
+        failures = {"GET": 2}
+
+        def datasources(request):
+            if failures["GET"] > 0:
+                failures["GET"] = failures["GET"] - 1
+                return 503, {"status": "Service Unavailable"}
+            return 200, [{"name": "CNSIM", "table": ["CNSIM1"]}]
+
+        self.adapter.handlers["GET", "/datasources"] = datasources
+        self._handle_sessions(1)
+        self.adapter.handlers["POST", "/datashield/session/s1/aggregate"] = lambda request: (
+            503,
+            {"status": "Service Unavailable"},
+        )
+        conn = self._connect()
+        conn.retry = RetryPolicy(max_retries=3, backoff=0.01)
+        # server errors of idempotent requests are retried
+        assert conn.list_tables() == ["CNSIM.CNSIM1"]
+        assert self.adapter.count("GET", "/datasources") == 3
+        # other requests are sent once
+        with pytest.raises(OpalDSError) as info:
+            conn.aggregate("meanDS(D$LAB_TSC)", asynchronous=False)
+        assert info.value.is_server_error()
+        assert self.adapter.count("POST", "/datashield/session/s1/aggregate") == 1
+
+    def test_breaker(self):
+        status = {"code": 503}
+
+        def datasources(request):
+            if status["code"] is None:
+                raise ValueError("Malformed response")
+            return status["code"], [{"name": "CNSIM", "table": ["CNSIM1"]}]
+
+        self.adapter.handlers["GET", "/datasources"] = datasources
+        conn = self._connect()
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.1)
+        OpalConnection.set_host_breaker(self.url, breaker)
+        try:
+            for _ in range(3):
+                with pytest.raises(HTTPError):
+                    conn.list_tables()
+            assert breaker.get_state() == CircuitBreaker.OPEN
+            # fails fast without sending the request, as a server error
+            with pytest.raises(OpalUnavailableError) as info:
+                conn.list_tables()
+            assert info.value.is_server_error()
+            assert not info.value.is_client_error()
+            assert self.adapter.count("GET", "/datasources") == 3
+            # a probe that fails with any error opens the circuit again
+            time.sleep(0.15)
+            assert breaker.get_state() == CircuitBreaker.HALF_OPEN
+            status["code"] = None
+            with pytest.raises(ValueError):
+                conn.list_tables()
+            assert breaker.get_state() == CircuitBreaker.OPEN
+            # a single successful probe closes the circuit
+            time.sleep(0.15)
+            status["code"] = 200
+            assert conn.list_tables() == ["CNSIM.CNSIM1"]
+            assert breaker.get_state() == CircuitBreaker.CLOSED
+            assert self.adapter.count("GET", "/datasources") == 5
+        finally:
+            OpalConnection.set_host_breaker(self.url, None)
+
+    def test_timeout(self):
+        def datasources(request):
+            # node that hangs instead of refusing the connection
+            raise ReadTimeout("Read timed out")
+
+        self.adapter.handlers["GET", "/datasources"] = datasources
+        conn = self._connect()
+        conn.retry = RetryPolicy(max_retries=1, backoff=0.01, timeout=(1, 5))
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        OpalConnection.set_host_breaker(self.url, breaker)
+        try:
+            with pytest.raises(ReadTimeout):
+                conn.list_tables()
+            # the timeout of the policy is applied, the timed out request is a failure that is retried
+            assert self.adapter.timeouts[-2:] == [(1, 5), (1, 5)]
+            assert breaker.get_state() == CircuitBreaker.OPEN
+            with pytest.raises(OpalUnavailableError):
+                conn.list_tables()
+            assert self.adapter.count("GET", "/datasources") == 2
+        finally:
+            OpalConnection.set_host_breaker(self.url, None)
+
+    def _handle_sessions(self, count: int = 4) -> None:
+        ids = iter([f"s{i}" for i in range(1, count + 1)])
+        self.adapter.handlers["POST", "/datashield/sessions"] = lambda request: (
+            201,
+            {"id": next(ids), "state": "RUNNING"},
+        )
+        for i in range(1, count + 1):
+            self.adapter.handlers["GET", f"/datashield/session/s{i}"] = lambda request: (200, {"state": "RUNNING"})
+            self.adapter.handlers["DELETE", f"/datashield/session/s{i}"] = lambda request: (200, {})
+
+    def test_sessions_limiter(self):
+        self._handle_sessions()
+        conn = self._connect()
+        conn.limiter = RequestLimiter(max_in_flight=1)
+        host_limiter = RequestLimiter(max_in_flight=2)
+        OpalConnection.set_host_limiter(self.url, host_limiter)
+        in_flight = []
+        handler = self.adapter.handlers["POST", "/datashield/sessions"]
+
+        def start(request):
+            in_flight.append((conn.limiter.get_stats()["in_flight"], host_limiter.get_stats()["in_flight"]))
+            return handler(request)
+
+        self.adapter.handlers["POST", "/datashield/sessions"] = start
+        try:
+            conn.start_sessions(4)
+            # the start, status and close requests of the R sessions are limited
+            assert in_flight == [(1, 1)] * 4
+            assert conn.get_sessions()[1].is_ready()
+            conn.disconnect()
+            session_calls = [call for call in self.adapter.calls if call[1].startswith("/datashield/session")]
+            assert self.adapter.count("DELETE", "/datashield/session/s4") == 1
+            assert conn.limiter.get_stats()["requests"] == len(session_calls)
+            assert host_limiter.get_stats()["requests"] == len(session_calls)
+        finally:
+            OpalConnection.set_host_limiter(self.url, None)
+
+    def test_sessions_breaker(self):
+        self._handle_sessions(2)
+        failures = {"count": 1}
+
+        def status(request):
+            if failures["count"] > 0:
+                failures["count"] = failures["count"] - 1
+                return 503, {"status": "Service Unavailable"}
+            return 200, {"state": "RUNNING"}
+
+        self.adapter.handlers["GET", "/datashield/session/s2"] = status
+        conn = self._connect()
+        conn.retry = RetryPolicy(max_retries=2, backoff=0.01)
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        OpalConnection.set_host_breaker(self.url, breaker)
+        try:
+            # the status checks of the R sessions are retried
+            rsession = conn.start_sessions(2)[1]
+            assert self.adapter.count("GET", "/datashield/session/s2") == 2
+            # and fail fast once the circuit is open
+            breaker.record_failure()
+            breaker.record_failure()
+            with pytest.raises(OpalUnavailableError):
+                rsession.is_pending()
+            with pytest.raises(OpalUnavailableError):
+                conn.start_sessions(3)
+            assert self.adapter.count("GET", "/datashield/session/s2") == 2
+            assert self.adapter.count("POST", "/datashield/sessions") == 2
+        finally:
+            OpalConnection.set_host_breaker(self.url, None)
+
+    def _async_results(self, count: int) -> tuple[list[OpalResult], list[threading.Event]]:
+        # R commands that are completed once their event is set
+        self._handle_sessions(1)
+        conn = self._connect()
+        conn.start_session(asynchronous=False)
+        completions = [threading.Event() for _ in range(count)]
+
+        def command(rid, completed):
+            def handler(request):
+                if "wait=true" in request.url and not completed.wait(request.timeout):
+                    raise ReadTimeout("Read timed out")
+                status = "COMPLETED" if completed.is_set() else "IN_PROGRESS"
+                return 200, {"id": rid, "status": status, "withResult": True}
+
+            return handler
+
+        for rid, completed in enumerate(completions):
+            self.adapter.handlers["GET", f"/datashield/session/s1/command/{rid}"] = command(str(rid), completed)
+        return [OpalResult(conn, rid=str(rid)) for rid in range(count)], completions
+
+    @staticmethod
+    def _pollers() -> list[threading.Thread]:
+        return [thread for thread in threading.enumerate() if thread.name.startswith("opal-poll")]
+
+    def test_as_completed(self):
+        results, completions = self._async_results(3)
+        completed = {}
+
+        def complete():
+            for rid in [2, 0, 1]:
+                time.sleep(0.1)
+                completed[rid] = time.monotonic()
+                completions[rid].set()
+
+        threading.Thread(target=complete).start()
+        yielded = []
+        for result in as_completed(results, timeout=5):
+            yielded.append(result)
+            # yielded as soon as the command is completed
+            assert time.monotonic() - completed[int(result.rid)] < 0.1
+        assert yielded == [results[2], results[0], results[1]]
+        assert all(result.is_completed() for result in results)
+
+    def test_as_completed_timeout(self):
+        results, completions = self._async_results(2)
+        completions[1].set()
+        started = time.monotonic()
+        iterator = as_completed(results, timeout=0.3)
+        assert next(iterator) is results[1]
+        with pytest.raises(TimeoutError):
+            next(iterator)
+        assert time.monotonic() - started < 1
+        # the not completed result is left untouched, and no request is left waiting on the server
+        assert results[0].cmd is None
+        assert not results[0].fetched
+        deadline = time.monotonic() + 1
+        while self._pollers():
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        completions[0].set()
+        assert list(as_completed([results[0]], timeout=5)) == [results[0]]
+
+    def test_wait_any(self):
+        results, completions = self._async_results(3)
+        done, not_done = wait_any(results, timeout=0.2)
+        assert done == []
+        assert not_done == results
+        completions[1].set()
+        done, not_done = wait_any(results, timeout=5)
+        assert done == [results[1]]
+        assert not_done == [results[0], results[2]]
+        completions[0].set()
+        completions[2].set()
+        done, not_done = wait_any(not_done, timeout=5)
+        assert len(done) >= 1
+        assert set(done + not_done) == {results[0], results[2]}
+
+    def test_prefetch_served_once(self):
+        release = threading.Event()
+
+        def datasources(request):
+            release.wait(5)
+            return 200, [{"name": "CNSIM", "table": ["CNSIM1"]}]
+
+        self.adapter.handlers["GET", "/datasources"] = datasources
+        conn = self._connect()
+        conn.prefetch()
+        key = ("/datasources", True)
+        prefetched = conn._prefetched[key][0]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            calls = [executor.submit(conn.list_tables) for _ in range(2)]
+            # one caller waits for the prefetch, the other one sends its own request
+            deadline = time.monotonic() + 5
+            while self.adapter.count("GET", "/datasources") < 2:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            # a newer prefetch is registered meanwhile
+            conn.prefetch()
+            newer = conn._prefetched[key][0]
+            release.set()
+            assert [call.result() for call in calls] == [["CNSIM.CNSIM1"]] * 2
+        assert prefetched.done()
+        assert newer is not prefetched
+        # the newer prefetch is kept for the next caller
+        assert conn._prefetched[key][0] is newer
+        newer.result(timeout=5)
+        assert conn.list_tables() == ["CNSIM.CNSIM1"]
+        assert self.adapter.count("GET", "/datasources") == 3
+        conn.disconnect()
+
+    def test_replay(self, tmp_path):
+        def exchange(key, body, latency=0.0, status=200):
+            content = base64.b64encode(json.dumps(body).encode("utf-8")).decode("ascii")
+            headers = {"Content-Type": "application/json"}
+            return {"key": key, "status": status, "headers": headers, "content": content, "latency": latency}
+
+        path = tmp_path / "exchanges.jsonl.gz"
+        exchanges = [
+            exchange("GET /ws/system/subject-profile/_current ", {"principal": "dsuser"}),
+            exchange("GET /ws/datasources ", [{"name": "CNSIM", "table": ["CNSIM1"]}], latency=0.2),
+            exchange("GET /ws/datasources ", [{"name": "CNSIM", "table": ["CNSIM1", "CNSIM2"]}]),
+            exchange("GET /ws/datasource/CNSIM/table/UNKNOWN ", {"status": "NoSuchValueTableInDatasource"}, status=404),
+        ]
+        with gzip.open(path, "wt", encoding="utf-8") as file:
+            for line in exchanges:
+                file.write(json.dumps(line) + "\n")
+        self.adapter = ReplayTransport(str(path), latency_scale=0.5)
+        conn = self._connect()
+        # identical requests get the recorded responses in order, with the scaled latency
+        started = time.monotonic()
+        assert conn.list_tables() == ["CNSIM.CNSIM1"]
+        assert time.monotonic() - started >= 0.1
+        assert conn.list_tables() == ["CNSIM.CNSIM1", "CNSIM.CNSIM2"]
+        # the last response is repeated once exhausted
+        assert conn.list_tables() == ["CNSIM.CNSIM1", "CNSIM.CNSIM2"]
+        assert not conn.has_table("CNSIM.UNKNOWN")
+        # a request that was not recorded fails as a connection error, without reaching any server
+        with pytest.raises(RequestsConnectionError):
+            conn.list_profiles()